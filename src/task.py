@@ -1,4 +1,5 @@
 import argparse
+from functools import cached_property
 import ee
 from task_base import SCLTask
 
@@ -48,12 +49,6 @@ class SCLEffectivePotentialHabitat(SCLTask):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.structural_habitat, _ = self.get_most_recent_image(
-            ee.ImageCollection(self.inputs["structural_habitat"]["ee_path"])
-        )
-        self.hii, _ = self.get_most_recent_image(
-            ee.ImageCollection(self.inputs["hii"]["ee_path"])
-        )
         self.extirpated_range = (
             self.historical_range_fc.filter(
                 ee.Filter.And(
@@ -68,6 +63,34 @@ class SCLEffectivePotentialHabitat(SCLTask):
         self.zones = ee.FeatureCollection(self.inputs["zones"]["ee_path"])
         self.states = ee.FeatureCollection(self.inputs["states"]["ee_path"])
 
+        # size and distance limits at self.scale, as plain ints
+        scale_km = self.scale / 1000
+        core_limits = self.density_values["core_size_limits"]
+        step_limits = self.density_values["step_size_limits"]
+        self.min_core_pixels = int(core_limits["min"] / scale_km**2)
+        self.max_core_pixels = int(core_limits["max"] / scale_km**2)
+        self.min_step_pixels = int(step_limits["min"] / scale_km**2)
+        self.max_step_pixels = int(step_limits["max"] / scale_km**2)
+        self.connectivity_pixels = int(
+            self.thresholds["dispersal_distance"] / 2 / scale_km
+        )
+
+    # most recent images are looked up on first use, so tasks that stop at
+    # check_inputs never pay for the collection queries
+    @cached_property
+    def structural_habitat(self):
+        structural_habitat, _ = self.get_most_recent_image(
+            ee.ImageCollection(self.inputs["structural_habitat"]["ee_path"])
+        )
+        return structural_habitat
+
+    @cached_property
+    def hii(self):
+        hii, _ = self.get_most_recent_image(
+            ee.ImageCollection(self.inputs["hii"]["ee_path"])
+        )
+        return hii
+
     def structural_habitat_path(self):
         return f"{self.ee_rootdir}/structural_habitat"
 
@@ -80,12 +103,6 @@ class SCLEffectivePotentialHabitat(SCLTask):
     def zones_path(self):
         return f"{self.speciesdir}/zones"
 
-    def distance_km_to_pixels(self, distance_km, image_resolution):
-        image_resolution = ee.Number(image_resolution)
-        scale_km = image_resolution.divide(1000)
-        pixel_distance = ee.Number(distance_km).divide(scale_km).int()
-        return pixel_distance
-
     def area_km_to_pixels(self, area_km, image_resolution):
         image_resolution = ee.Number(image_resolution)
         resolution_km = image_resolution.divide(1000)
@@ -93,31 +110,38 @@ class SCLEffectivePotentialHabitat(SCLTask):
         n_pixels = ee.Number(area_km).divide(scale_km).int()
         return n_pixels
 
-    def density_to_patch_size(self, ft):
-        med_density_eco = ee.Number(ft.get("MED_DENSITY_ECO"))
-        med_density_biome = ee.Number(ft.get("MED_DENSITY_BIOME"))
-        density_val = ee.Algorithms.If(
-            med_density_eco.gt(0),
-            med_density_eco,
-            ee.Algorithms.If(med_density_biome.gt(0), med_density_biome, 1),
-        )
-        min_core_size = (
-            ee.Number(self.density_values["n_core_animals"])
-            .divide(density_val)
-            .multiply(100)
-            .int()
-        )
-        # min_core_size_pixels = self.area_km_to_pixels(min_core_size, self.scale)
+    def density_to_patch_size(self, med_density_eco, med_density_biome):
+        # missing densities come back as None and count as not > 0
+        if med_density_eco is not None and med_density_eco > 0:
+            density_val = med_density_eco
+        elif med_density_biome is not None and med_density_biome > 0:
+            density_val = med_density_biome
+        else:
+            density_val = 1
         # return km2 required to be a patch
-        return ee.Feature(
-            None,
-            {"ECO_ID": ft.get("ECO_ID"), "min_core_size": min_core_size},
+        return int(self.density_values["n_core_animals"] / density_val * 100)
+
+    def min_core_size_table(self):
+        # density is static and small: fetch it in one request and build the
+        # ecoregion -> min core size table client-side. Fetch properties only,
+        # without geometry, rather than reduceColumns, which drops rows with
+        # any null column.
+        density_table = self.density.filter(ee.Filter.notNull(["ECO_ID"])).select(
+            ["ECO_ID", "MED_DENSITY_ECO", "MED_DENSITY_BIOME"], None, False
         )
+        density_rows = [ft["properties"] for ft in density_table.getInfo()["features"]]
+        ecoregion_ids = [row["ECO_ID"] for row in density_rows]
+        core_sizes = [
+            self.density_to_patch_size(
+                row.get("MED_DENSITY_ECO"), row.get("MED_DENSITY_BIOME")
+            )
+            for row in density_rows
+        ]
+        return ecoregion_ids, core_sizes
 
-    def dilate(self, image, distance):
-        pixel_distance = self.distance_km_to_pixels(distance, self.scale)
-        dialated_image = image.fastDistanceTransform(pixel_distance).sqrt()
-        return dialated_image.lte(pixel_distance).selfMask()
+    def dilate(self, image, pixel_distance):
+        dialated_image = image.unmask(0).focalMax(pixel_distance, "circle", "pixels")
+        return dialated_image.selfMask()
 
     def calc(self):
         structural_habitat_mask = self.structural_habitat.gte(
@@ -131,7 +155,6 @@ class SCLEffectivePotentialHabitat(SCLTask):
         connected_structural_habitat = (
             structural_habitat_mask.connectedPixelCount(str_hab_connected_pixels, True)
             .gte(str_hab_connected_pixels)
-            .selfMask()
             .reproject(self.crs, None, str_hab_resolution)
         )
 
@@ -148,117 +171,96 @@ class SCLEffectivePotentialHabitat(SCLTask):
                 self.thresholds["hii"]["zone_4"],
             ],
         )
-        low_hii_mask = self.hii.divide(100).lte(hii_threshold_image).selfMask()
+        low_hii_mask = self.hii.divide(100).lte(hii_threshold_image)
 
-        eff_pot_hab = (
-            structural_habitat_mask.updateMask(low_hii_mask)
+        # reduce both habitat masks in a single reduceResolution pass
+        reduced_habitat = (
+            structural_habitat_mask.addBands(connected_structural_habitat)
+            .updateMask(low_hii_mask)
             .unmask(0)
             .reduceResolution(ee.Reducer.mean())
             .gte(self.thresholds["reduce_res_input_pixels"])
             .selfMask()
-            .rename("eff_pot_hab")
         )
-        eff_pot_hab_export = (
-            connected_structural_habitat.updateMask(low_hii_mask)
-            .unmask(0)
-            .reduceResolution(ee.Reducer.mean())
-            .gte(self.thresholds["reduce_res_input_pixels"])
+        eff_pot_hab = reduced_habitat.select(0).rename("eff_pot_hab")
+        eff_pot_hab_export = reduced_habitat.select(1).rename("eff_pot_hab")
+
+        # drop patches smaller than a stepping stone with a cheap count capped
+        # at min_step_pixels, then count the survivors up to max_core_pixels
+        step_sized_habitat = (
+            eff_pot_hab.connectedPixelCount(self.min_step_pixels, True)
+            .gte(self.min_step_pixels)
             .selfMask()
-            .rename("eff_pot_hab")
-        )
-
-        max_core_pixels = self.area_km_to_pixels(
-            self.density_values["core_size_limits"]["max"], self.scale
-        )
-        min_core_pixels = self.area_km_to_pixels(
-            self.density_values["core_size_limits"]["min"], self.scale
         )
-        max_step_pixels = self.area_km_to_pixels(
-            self.density_values["step_size_limits"]["max"], self.scale
+        potential_habitat = step_sized_habitat.connectedPixelCount(
+            self.max_core_pixels, True
         )
-        min_step_pixels = self.area_km_to_pixels(
-            self.density_values["step_size_limits"]["min"], self.scale
-        )
-
-        connected_potential_habitat = eff_pot_hab.connectedPixelCount(
-            max_core_pixels, True
-        ).reproject(crs=self.crs, scale=self.scale)
-        potential_habitat = connected_potential_habitat.updateMask(
-            connected_potential_habitat.gte(min_step_pixels)
-        ).selfMask()
 
-        country_image = self.states.reduceToImage(
-            properties=["isonumeric"], reducer=ee.Reducer.mode()
-        )
-        state_image = self.states.reduceToImage(
-            properties=["gadm1code"], reducer=ee.Reducer.mode()
-        )
-        ecoregion_image = self.ecoregions.reduceToImage(
-            properties=["ECO_ID"], reducer=ee.Reducer.mode()
+        # rasterize each FeatureCollection once, one band per property
+        admin_image = self.states.reduceToImage(
+            properties=["isonumeric", "gadm1code"],
+            reducer=ee.Reducer.mode().forEach(["country", "state"]),
         )
-        biome_image = self.ecoregions.reduceToImage(
-            properties=["BIOME_NUM"], reducer=ee.Reducer.mode()
+        country_image = admin_image.select("country")
+        state_image = admin_image.select("state")
+        ecoregions_image = self.ecoregions.reduceToImage(
+            properties=["ECO_ID", "BIOME_NUM"],
+            reducer=ee.Reducer.mode().forEach(["ecoregion", "biome"]),
         )
-        density = self.density.map(self.density_to_patch_size)
-        ecoregion_id = density.aggregate_array("ECO_ID")
-        core_size = density.aggregate_array("min_core_size")
+        ecoregion_image = ecoregions_image.select("ecoregion")
+        biome_image = ecoregions_image.select("biome")
+        ecoregion_id, core_size = self.min_core_size_table()
 
         min_patch_size = (
             ecoregion_image.remap(ecoregion_id, core_size)
             .int()
             .clamp(
-                min_core_pixels,
-                max_core_pixels,
+                self.min_core_pixels,
+                self.max_core_pixels,
             )
         )
         min_stepping_stone_size = (
             min_patch_size.multiply(self.density_values["core_to_step_ratio"])
             .int()
             .clamp(
-                min_step_pixels,
-                max_step_pixels,
+                self.min_step_pixels,
+                self.max_step_pixels,
             )
         )
 
-        connectivity_distance = self.thresholds["dispersal_distance"] / 2
-        potential_core = (
-            self.dilate(
-                ee.Image(0).where(potential_habitat.gte(min_patch_size), 1).selfMask(),
-                connectivity_distance,
-            )
-            .reproject(crs=self.crs, scale=self.scale)
+        # potential habitat class:
+        # 3: core
+        # 1: stepping stone
+        # a single dilation grows both classes, with core winning where they meet
+        potential_class = (
+            potential_habitat.gte(min_patch_size)
             .multiply(3)
-            .unmask(0)
-            .updateMask(self.watermask)
-        )
-        potential_stepping_stone = (
-            self.dilate(
-                ee.Image(0)
-                .where(
-                    potential_habitat.lt(min_patch_size).And(
-                        potential_habitat.gte(min_stepping_stone_size)
-                    ),
-                    1,
-                )
-                .selfMask(),
-                connectivity_distance,
+            .where(
+                potential_habitat.lt(min_patch_size).And(
+                    potential_habitat.gte(min_stepping_stone_size)
+                ),
+                1,
             )
-            .reproject(crs=self.crs, scale=self.scale)
-            .unmask(0)
-            .updateMask(self.watermask)
         )
-
-        allpotential = potential_core.add(potential_stepping_stone).selfMask()
+        allpotential = self.dilate(
+            potential_class, self.connectivity_pixels
+        ).updateMask(self.watermask)
 
         # range reclass:
         # 0: neither historic or extirpated range
         # 1: extirpated
         # 2: historical
         range_class = (
-            ee.Image(0)
-            .where(self.historical_range.eq(1), ee.Image(2))
-            .where(self.extirpated_range.eq(1), ee.Image(1))
-        ).selfMask()
+            ee.Image()
+            .expression(
+                "ext == 1 ? 1 : hist == 1 ? 2 : 0",
+                {
+                    "hist": self.historical_range.unmask(0),
+                    "ext": self.extirpated_range,
+                },
+            )
+            .selfMask()
+        )
 
         paimage = self.pas.reduceToImage(["WDPAID"], ee.Reducer.first())
 
@@ -283,9 +285,10 @@ class SCLEffectivePotentialHabitat(SCLTask):
             "pa_area",
         ]
 
+        # mask every band, not just scl_poly, so tiles outside potential
+        # habitat are empty for all inputs to reduceToVectors
         scl_image = (
-            state_image.updateMask(allpotential)
-            .addBands(
+            state_image.addBands(
                 [
                     range_class,
                     country_image,
@@ -301,6 +304,7 @@ class SCLEffectivePotentialHabitat(SCLTask):
                 ]
             )
             .rename(["scl_poly"] + mode_bands + sum_bands)
+            .updateMask(allpotential)
         )
         scl_polys = scl_image.reduceToVectors(
             reducer=ee.Reducer.mode()